@@ -1,7 +1,10 @@
 import numpy as np
 import faiss
-from scipy.sparse.csgraph import laplacian
-from scipy.linalg.blas import sgemm
+from scipy.linalg import eigh
+from scipy.sparse.linalg import eigsh
+from scipy.linalg.blas import get_blas_funcs
+
+_gemm = get_blas_funcs("gemm", dtype=np.float32)
 
 
 class _KMeans:
@@ -17,6 +20,14 @@ class _KMeans:
         Number of seeding trials for centroids initialization.
     random_state : int or None, optional, default=None
         Determines random number generation for centroid initialization.
+    use_gpu : bool, optional, default=False
+        Whether to run the k-means iterations on GPU (requires faiss-gpu).
+    use_float16 : bool, optional, default=False
+        Whether to store the data in half precision on GPU.
+    gpu_resources : faiss.StandardGpuResources or None, optional, default=None
+        GPU resources to run on, created on the fly if None.
+    init : {"k-means++", "k-means||"}, optional, default="k-means++"
+        Centroids initialization method.
 
     Attributes:
     -----------
@@ -37,66 +48,142 @@ class _KMeans:
         n_iter=20,
         n_local_trials=None,
         random_state=None,
+        use_gpu=False,
+        use_float16=False,
+        gpu_resources=None,
+        init="k-means++",
     ):
         self.n_clusters = n_clusters
         self.n_iter = n_iter
         self.n_local_trials = n_local_trials
         self.random_state = random_state
-
-    def _dists(self, X, y, XX):
-        yy = np.einsum("ij,ij->i", y, y)
-        dists = XX - sgemm(2.0, X, y, trans_b=True) + yy
-        np.clip(dists, 0, None, out=dists)
-        return dists
-
-    def _init_centroids(self, X):
+        self.use_gpu = use_gpu
+        self.use_float16 = use_float16
+        self.gpu_resources = gpu_resources
+        self.init = init
+
+    def _dists(self, X, XX, ids, out):
+        _gemm(-2.0, X.T, X[ids].T, c=out.T, trans_a=True, overwrite_c=True)
+        out += XX
+        out += XX[ids, None]
+        np.maximum(out, 0, out=out)
+        return out
+
+    def _init_centroids(self, X, XX, rng, weights=None):
         assert np.any(np.isnan(X)) == False
 
-        rng = np.random.default_rng(self.random_state)
+        n = X.shape[0]
+        if weights is None:
+            first = rng.integers(n)
+        else:
+            cum_weights = np.cumsum(weights, dtype=np.float64)
+            u = rng.random() * cum_weights[-1]
+            first = min(np.searchsorted(cum_weights, u, side="right"), n - 1)
 
         centroids = np.empty((self.n_clusters, X.shape[1]), dtype=X.dtype)
-        centroids[0] = X[rng.integers(X.shape[0])]
-
-        XX = np.einsum("ij,ij->i", X, X)[:, None]
+        centroids[0] = X[first]
 
-        dists = self._dists(X, centroids[0:1], XX).ravel()
-        inertia = dists.sum()
+        dists = np.empty(n, dtype=np.float32)
+        self._dists(X, XX, [first], dists[None, :])
 
         if self.n_local_trials is None:
             self.n_local_trials = 2 + int(np.log(self.n_clusters))
 
-        for i in range(1, self.n_clusters):
-            candidate_ids = rng.choice(
-                X.shape[0], size=self.n_local_trials, p=dists / inertia
-            )
-            candidates = np.asfortranarray(X[candidate_ids])
-
-            current_candidates_dists = self._dists(X, candidates, XX)
-            candidates_dists = np.minimum(current_candidates_dists, dists[:, None])
+        cum_dists = np.empty(n, dtype=np.float64)
+        scratch = np.empty((self.n_local_trials, n), dtype=np.float32)
 
-            inertias = candidates_dists.sum(axis=0)
+        for i in range(1, self.n_clusters):
+            if weights is None:
+                np.cumsum(dists, dtype=np.float64, out=cum_dists)
+            else:
+                np.cumsum(dists * weights, dtype=np.float64, out=cum_dists)
+            u = rng.random(self.n_local_trials) * cum_dists[-1]
+            candidate_ids = np.searchsorted(cum_dists, u, side="right")
+            np.minimum(candidate_ids, n - 1, out=candidate_ids)
+
+            self._dists(X, XX, candidate_ids, scratch)
+            np.minimum(scratch, dists, out=scratch)
+
+            if weights is None:
+                inertias = scratch.sum(axis=1)
+            else:
+                inertias = scratch @ weights
             best_inertia = inertias.argmin()
             best_candidate = candidate_ids[best_inertia]
-            dists = candidates_dists[:, best_inertia]
-            inertia = inertias[best_inertia]
+            dists[:] = scratch[best_inertia]
 
             centroids[i] = X[best_candidate]
 
         return centroids
 
-    def fit(self, X):
+    def _init_centroids_parallel(self, X, XX, rng, n_rounds=5):
+        assert np.any(np.isnan(X)) == False
+
+        n, d = X.shape
+        oversampling = 2 * self.n_clusters / n_rounds
+
+        candidate_ids = [rng.integers(n)]
+        dists = np.empty(n, dtype=np.float32)
+        self._dists(X, XX, candidate_ids, dists[None, :])
+
+        for _ in range(n_rounds):
+            inertia = dists.sum(dtype=np.float64)
+            if inertia == 0:
+                break
+
+            probs = oversampling / inertia * dists
+            new_ids = np.flatnonzero(rng.random(n) < probs)
+            if new_ids.size == 0:
+                continue
+
+            index = faiss.IndexFlatL2(d)
+            index.add(X[new_ids])
+            new_dists = index.search(X, 1)[0].ravel()
+            np.minimum(dists, np.maximum(new_dists, 0), out=dists)
+            candidate_ids.extend(new_ids)
+
+        if len(candidate_ids) < self.n_clusters:
+            return self._init_centroids(X, XX, rng)
+
+        candidates = X[candidate_ids]
+        index = faiss.IndexFlatL2(d)
+        index.add(candidates)
+        weights = np.bincount(
+            index.assign(X, 1).ravel(), minlength=len(candidate_ids)
+        ).astype(np.float32)
+
+        return self._init_centroids(candidates, XX[candidate_ids], rng, weights)
+
+    def fit(self, X, X_norms=None):
         """Run k-means clustering on the input data X.
 
         Parameters:
         -----------
         X : numpy.ndarray
             Input data to cluster.
+        X_norms : numpy.ndarray or None, optional, default=None
+            Precomputed squared euclidean norms of the rows of X.
         """
-        X_f32 = np.array(X, dtype=np.float32, order="F")
-        index = faiss.IndexFlatL2(X.shape[1])
+        X_f32 = np.ascontiguousarray(X, dtype=np.float32)
+        if X_norms is None:
+            X_norms = np.einsum("ij,ij->i", X_f32, X_f32)
+
+        if self.use_gpu:
+            res = self.gpu_resources
+            if res is None:
+                res = faiss.StandardGpuResources()
+            config = faiss.GpuIndexFlatConfig()
+            config.useFloat16 = self.use_float16
+            index = faiss.GpuIndexFlatL2(res, X.shape[1], config)
+        else:
+            index = faiss.IndexFlatL2(X.shape[1])
         kmeans = faiss.Clustering(X.shape[1], self.n_clusters)
 
-        init_centroids = self._init_centroids(X_f32)
+        rng = np.random.default_rng(self.random_state)
+        if self.init == "k-means||":
+            init_centroids = self._init_centroids_parallel(X_f32, X_norms, rng)
+        else:
+            init_centroids = self._init_centroids(X_f32, X_norms, rng)
 
         kmeans.centroids.resize(init_centroids.size)
         faiss.copy_array_to_vector(init_centroids.ravel(), kmeans.centroids)
@@ -108,7 +195,9 @@ class _KMeans:
         self.cluster_centers_ = faiss.vector_to_array(kmeans.centroids).reshape(
             self.n_clusters, X.shape[1]
         )
-        self.labels_ = index.search(X_f32, 1)[1].ravel()
+        # train() leaves the final centroids in index, but its last assignment
+        # predates the final update, so labels need one more pass.
+        self.labels_ = index.assign(X_f32, 1).ravel()
 
 
 class _SpectralClustering:
@@ -126,7 +215,7 @@ class _SpectralClustering:
     labels_ : numpy.ndarray
         Labels of each point (index) in the affinity matrix.
     eigvals_ : numpy.ndarray
-        The eigenvalues of the (normalized) laplacian
+        The n_clusters + 1 smallest eigenvalues of the (normalized) laplacian
 
     Methods:
     --------
@@ -149,11 +238,38 @@ class _SpectralClustering:
         affinity : numpy.ndarray
             Affinity matrix representing pairwise similarity between points.
         """
-        L = laplacian(affinity, normed=True)
-
-        self.eigvals_, eigvecs = np.linalg.eigh(L)
-        eigvecs = eigvecs[:, : self.n_clusters]
-        eigvecs /= np.linalg.norm(eigvecs, axis=1)[:, None]
+        # The eigengap is sensitive to rounding near zero, so the laplacian is
+        # built and decomposed in double precision; it is only n_nodes x n_nodes.
+        affinity = affinity.astype(np.float64)
+        np.fill_diagonal(affinity, 0)
+        degrees = affinity.sum(axis=1)
+        isolated = degrees == 0
+        degrees[isolated] = 1
+        inv_sqrt_degrees = 1 / np.sqrt(degrees)
+
+        L = affinity
+        L *= inv_sqrt_degrees[:, None]
+        L *= inv_sqrt_degrees[None, :]
+        np.negative(L, out=L)
+        np.fill_diagonal(L, ~isolated)
+
+        n_nodes = L.shape[0]
+        k = self.n_clusters + 1
+
+        if n_nodes < 3 * self.n_clusters:
+            self.eigvals_, eigvecs = eigh(L, subset_by_index=[0, k - 1])
+        else:
+            rng = np.random.default_rng(self.random_state)
+            v0 = rng.uniform(-1, 1, n_nodes)
+            eigvals, eigvecs = eigsh(L, k=k, sigma=1e-10, which="LM", v0=v0)
+            order = np.argsort(eigvals)
+            self.eigvals_, eigvecs = eigvals[order], eigvecs[:, order]
+
+        eigvecs = np.ascontiguousarray(eigvecs[:, : self.n_clusters], dtype=np.float32)
+        norms = np.einsum("ij,ij->i", eigvecs, eigvecs)
+        np.sqrt(norms, out=norms)
+        np.maximum(norms, 1e-12, out=norms)
+        eigvecs /= norms[:, None]
         kmeans = _KMeans(self.n_clusters, random_state=self.random_state)
         kmeans.fit(eigvecs)
 
@@ -181,7 +297,17 @@ class SpectralBridges:
     n_local_trials : int or None, optional, default=None
         Number of seeding trials for centroids initialization.
     random_state : int or None, optional, default=None
-        Determines random number generation for centroid initialization.
+        Determines random number generation for centroid initialization, and
+        for the subsample of affinities used to estimate the scale gamma when
+        n_nodes exceeds 100.
+    use_gpu : bool, optional, default=False
+        Whether to run the k-means iterations on GPU (requires faiss-gpu).
+    use_float16 : bool, optional, default=False
+        Whether to store the data in half precision on GPU, trading accuracy
+        for memory and speed. Only used when use_gpu is True.
+    init : {"k-means++", "k-means||"}, optional, default="k-means++"
+        Initialization method of the k-means step. "k-means||" seeds in a
+        few oversampling rounds, which is faster when n_nodes is large.
 
     Methods:
     --------
@@ -200,6 +326,9 @@ class SpectralBridges:
         n_iter=20,
         n_local_trials=None,
         random_state=None,
+        use_gpu=False,
+        use_float16=False,
+        init="k-means++",
     ):
         assert n_clusters > 0
         if n_nodes is not None:
@@ -209,6 +338,9 @@ class SpectralBridges:
         assert n_iter > 0
         if n_local_trials is not None:
             assert n_local_trials > 0
+        if use_gpu:
+            assert hasattr(faiss, "StandardGpuResources")
+        assert init in ("k-means++", "k-means||")
 
         self.n_clusters = n_clusters
         self.n_nodes = n_nodes
@@ -217,9 +349,26 @@ class SpectralBridges:
         self.n_iter = n_iter
         self.n_local_trials = n_local_trials
         self.random_state = random_state
+        self.use_gpu = use_gpu
+        self.use_float16 = use_float16
+        self.init = init
         self.cluster_centers_ = None
         self.eigvals_ = None
         self.ngap_ = None
+        self._index = None
+        self._cluster_cutoffs = None
+        self._gpu_resources = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_index"] = None
+        state["_gpu_resources"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.cluster_centers_ is not None:
+            self._build_index()
 
     def fit(self, X):
         """Fit the Spectral Bridges model on the input data X.
@@ -229,6 +378,15 @@ class SpectralBridges:
         X : numpy.ndarray
             Input data to cluster.
         """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self._fit(X, np.einsum("ij,ij->i", X, X))
+
+    def _get_gpu_resources(self):
+        if self._gpu_resources is None:
+            self._gpu_resources = faiss.StandardGpuResources()
+        return self._gpu_resources
+
+    def _fit(self, X, X_norms):
         assert self.n_nodes > self.n_clusters
 
         kmeans = _KMeans(
@@ -236,43 +394,91 @@ class SpectralBridges:
             n_iter=self.n_iter,
             n_local_trials=self.n_local_trials,
             random_state=self.random_state,
+            use_gpu=self.use_gpu,
+            use_float16=self.use_float16,
+            gpu_resources=self._get_gpu_resources() if self.use_gpu else None,
+            init=self.init,
         )
-        kmeans.fit(X)
-
-        affinity = np.empty((self.n_nodes, self.n_nodes))
-
-        X_centered = [
-            np.array(
-                X[kmeans.labels_ == i] - kmeans.cluster_centers_[i],
-                dtype=np.float32,
-                order="F",
-            )
-            for i in range(self.n_nodes)
-        ]
-
-        counts = np.array([X_centered[i].shape[0] for i in range(self.n_nodes)])
-        counts = counts[None, :] + counts[:, None]
-
-        for i in range(self.n_nodes):
-            segments = np.asfortranarray(
-                kmeans.cluster_centers_ - kmeans.cluster_centers_[i]
+        kmeans.fit(X, X_norms)
+
+        centers = kmeans.cluster_centers_
+        labels = kmeans.labels_
+        order = np.argsort(labels, kind="stable")
+        labels_sorted = labels[order]
+        X_sorted = X[order]
+        np.subtract(X_sorted, centers[labels_sorted], out=X_sorted)
+
+        sizes = np.bincount(labels, minlength=self.n_nodes)
+        offsets = np.concatenate(([0], np.cumsum(sizes)))
+        counts = (sizes[None, :] + sizes[:, None]).astype(np.float32)
+
+        centers_64 = centers.astype(np.float64)
+        sq_norms = np.einsum("ij,ij->i", centers_64, centers_64)
+        dists = sq_norms[:, None] + sq_norms[None, :] - 2 * centers_64 @ centers_64.T
+        np.clip(dists, 0, None, out=dists)
+        np.fill_diagonal(dists, 1)
+        inv_dists = (1 / dists).astype(np.float32)
+
+        # Projections are invariant to translating the centers; working around
+        # their mean keeps the dot products below well conditioned in float32.
+        centers_shifted = centers - centers.mean(axis=0)
+
+        affinity = np.zeros((self.n_nodes, self.n_nodes), dtype=np.float32)
+        max_rows = max(1, 2**20 // self.n_nodes)
+        buffer = np.empty(0, dtype=np.float32)
+
+        start = 0
+        while start < self.n_nodes:
+            stop = np.searchsorted(offsets, offsets[start] + max_rows, side="right")
+            stop = min(max(stop - 1, start + 1), self.n_nodes)
+            rows = slice(offsets[start], offsets[stop])
+            batch_labels = labels_sorted[rows]
+
+            size = (offsets[stop] - offsets[start]) * self.n_nodes
+            if buffer.size < size:
+                buffer = np.empty(max(size, 2**20), dtype=np.float32)
+            projs = buffer[:size].reshape(-1, self.n_nodes)
+
+            _gemm(
+                1.0,
+                centers_shifted.T,
+                X_sorted[rows].T,
+                c=projs.T,
+                trans_a=True,
+                overwrite_c=True,
             )
-            dists = np.einsum("ij,ij->i", segments, segments)
-            dists[i] = 1
-
-            projs = sgemm(1.0, X_centered[i], segments, trans_b=True)
-            np.clip(projs / dists, 0, None, out=projs)
-            projs = np.power(projs, self.p)
+            projs -= np.take_along_axis(projs, batch_labels[:, None], axis=1)
+            projs *= inv_dists[batch_labels]
+            np.clip(projs, 0, None, out=projs)
+            np.power(projs, self.p, out=projs)
+
+            nonempty = np.flatnonzero(sizes[start:stop]) + start
+            if nonempty.size > 0:
+                affinity[nonempty] = np.add.reduceat(
+                    projs, offsets[nonempty] - offsets[start], axis=0
+                )
 
-            affinity[i] = projs.sum(axis=0)
+            start = stop
 
-        affinity = np.power((affinity + affinity.T) / counts, 1 / self.p)
+        affinity += affinity.T
+        affinity /= counts
+        np.power(affinity, 1 / self.p, out=affinity)
         affinity -= 0.5 * affinity.max()
 
-        q10, q90 = np.quantile(affinity, [0.1, 0.9])
+        # gamma only needs a robust scale estimate, so large affinity matrices
+        # are subsampled rather than scanned in full. The subsample draws from
+        # its own stream so that it does not replay the k-means seeding.
+        entries = affinity.ravel()
+        if entries.size > 10000:
+            seed = np.random.SeedSequence(self.random_state, spawn_key=(1,))
+            rng = np.random.default_rng(seed)
+            entries = rng.choice(entries, size=10000, replace=False)
 
-        gamma = np.log(self.M) / (q90 - q10)
-        affinity = np.exp(gamma * affinity)
+        q10, q90 = np.quantile(entries, [0.1, 0.9])
+
+        gamma = np.float32(np.log(self.M) / (q90 - q10))
+        affinity *= gamma
+        np.exp(affinity, out=affinity)
 
         spectralclustering = _SpectralClustering(
             self.n_clusters, random_state=self.random_state
@@ -285,6 +491,7 @@ class SpectralBridges:
             kmeans.cluster_centers_[spectralclustering.labels_ == i]
             for i in range(self.n_clusters)
         ]
+        self._build_index()
 
     def fit_select(self, X, n_nodes_range=None, n_redo=10):
         """
@@ -322,6 +529,9 @@ class SpectralBridges:
             assert self.n_nodes is not None
             n_nodes_range = [self.n_nodes]
 
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        X_norms = np.einsum("ij,ij->i", X, X)
+
         rng = np.random.default_rng(self.random_state)
         max_int = np.iinfo(np.int32).max
 
@@ -342,8 +552,13 @@ class SpectralBridges:
                     n_iter=self.n_iter,
                     n_local_trials=self.n_local_trials,
                     random_state=self.random_state,
+                    use_gpu=self.use_gpu,
+                    use_float16=self.use_float16,
+                    init=self.init,
                 )
-                model.fit(X)
+                if self.use_gpu:
+                    model._gpu_resources = self._get_gpu_resources()
+                model._fit(X, X_norms)
 
                 cum_ngap += model.ngap_
 
@@ -363,6 +578,14 @@ class SpectralBridges:
 
         return mean_ngaps
 
+    def _build_index(self):
+        cluster_centers = np.vstack(self.cluster_centers_).astype(np.float32)
+        self._cluster_cutoffs = np.cumsum(
+            [cluster.shape[0] for cluster in self.cluster_centers_]
+        )
+        self._index = faiss.IndexFlatL2(cluster_centers.shape[1])
+        self._index.add(cluster_centers)
+
     def predict(self, x):
         """Predict the nearest cluster index for each input data point x.
 
@@ -378,15 +601,9 @@ class SpectralBridges:
         """
         assert np.any(np.isnan(x)) == False
 
-        cluster_centers = np.vstack(self.cluster_centers_)
-        cluster_cutoffs = np.cumsum(
-            [cluster.shape[0] for cluster in self.cluster_centers_]
-        )
-
-        index = faiss.IndexFlatL2(x.shape[1])
-        index.add(cluster_centers.astype(np.float32))
-        winners = index.search(x.astype(np.float32), 1)[1].ravel()
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        winners = self._index.assign(x, 1).ravel()
 
-        labels = np.searchsorted(cluster_cutoffs, winners, side="right")
+        labels = np.searchsorted(self._cluster_cutoffs, winners, side="right")
 
         return labels